@@ -28,6 +28,10 @@ import math
 import json
 import ssl
 import sys
+import selectors
+import functools
+import logging
+import queue
 
 # MQTT imports
 try:
@@ -36,22 +40,109 @@ except ImportError as e:
     print("Error: paho-mqtt library not found. Install with: pip install paho-mqtt")
     sys.exit(1)
 
+# orjson is optional - it encodes several times faster and returns bytes that paho sends as-is
+try:
+    import orjson
+    encode_payload = orjson.dumps
+except ImportError:
+    def encode_payload(data):
+        return json.dumps(data).encode()
+
+try:
+    import numpy as np
+except ImportError as e:
+    print("Error: numpy library not found. Install with: pip install numpy")
+    sys.exit(1)
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 parser = argparse.ArgumentParser(description='Sketch flash loader with MQTT publishing')
 parser.add_argument("uart", help="uart port to use", type=str, default="/dev/ttyUSB0", nargs='?')
 parser.add_argument("nodes", help="node lists",type=str, default="[]", nargs='?')
 parser.add_argument("--mqtt-broker", help="MQTT broker hostname", type=str, default="mqtt.dynamicdevices.co.uk")
 parser.add_argument("--mqtt-port", help="MQTT broker port", type=int, default=8883)
 parser.add_argument("--mqtt-topic", help="MQTT topic to publish to", type=str, default="uwb/positions")
-parser.add_argument("--mqtt-rate-limit", help="Minimum seconds between MQTT publishes", type=float, default=10.0)
+parser.add_argument("--mqtt-rate-limit", help="Average seconds between MQTT publishes once the burst allowance is used up", type=float, default=10.0)
+parser.add_argument("--mqtt-burst", help="Number of MQTT publishes allowed back-to-back before rate limiting applies", type=positive_int, default=3)
+parser.add_argument("--mqtt-qos", help="MQTT QoS level for position data (0 = fire and forget)", type=int, choices=[0, 1, 2], default=0)
+parser.add_argument("--mqtt-batch-size", help="Number of position frames to send in one MQTT message", type=positive_int, default=1)
+parser.add_argument("--mqtt-batch-interval", help="Maximum seconds to hold a partial batch before publishing", type=float, default=5.0)
+parser.add_argument("--mqtt-only-when-subscribed", help="Pause publishing while the broker reports no subscribers (needs --mqtt-qos 1 or 2)", action="store_true")
+parser.add_argument("--mqtt-insecure", help="Skip MQTT broker TLS certificate verification", action="store_true")
 parser.add_argument("--disable-mqtt", help="Disable MQTT publishing", action="store_true")
 parser.add_argument("--verbose", help="Enable verbose logging", action="store_true")
 parser.add_argument("--quiet", help="Enable quiet mode (minimal logging)", action="store_true")
 
 args = parser.parse_args()
 
+# Options read on every packet or log call are bound once to avoid attribute lookups in the hot loop
+VERBOSE = args.verbose
+QUIET = args.quiet
+DISABLE_MQTT = args.disable_mqtt
+MQTT_TOPIC = args.mqtt_topic
+MQTT_QOS = args.mqtt_qos
+MQTT_BURST = args.mqtt_burst
+MQTT_BATCH_SIZE = args.mqtt_batch_size
+MQTT_BATCH_INTERVAL = args.mqtt_batch_interval
+
+# Startup messages are printed even in quiet mode, so they sit above ERROR
+STARTUP = logging.ERROR + 5
+logging.addLevelName(STARTUP, "STARTUP")
+
+class LogFormatter(logging.Formatter):
+    """Prefix messages by level, leaving info and startup messages bare"""
+    PREFIXES = {
+        logging.DEBUG: "[VERBOSE] ",
+        logging.WARNING: "[WARNING] ",
+        logging.ERROR: "[ERROR] "
+    }
+
+    def format(self, record):
+        return self.PREFIXES.get(record.levelno, "") + super().format(record)
+
+log_handler = logging.StreamHandler(sys.stdout)
+log_handler.setFormatter(LogFormatter("%(message)s"))
+logger = logging.getLogger("uwb_pub")
+logger.addHandler(log_handler)
+logger.propagate = False
+if VERBOSE:
+    logger.setLevel(logging.DEBUG)
+elif QUIET:
+    logger.setLevel(logging.ERROR)
+else:
+    logger.setLevel(logging.INFO)
+
 # MQTT globals
 mqtt_client = None
-last_publish_time = 0
+
+# TLS context is built once and reused on every reconnect so OpenSSL can resume sessions
+tls_context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+if args.mqtt_insecure:
+    tls_context.check_hostname = False
+    tls_context.verify_mode = ssl.CERT_NONE
+
+# Frames waiting to be published together when --mqtt-batch-size > 1
+pending_batch = []
+batch_started = 0.0
+
+# Encoded payloads handed from the serial loop to the MQTT publish worker
+publish_queue = queue.Queue(maxsize=100)
+publish_thread = None
+
+# Raw TWR values are in device time units; valid distances are below 300m, which
+# is checked on the raw integer so only accepted values need scaling
+TWR_SCALE = 0.004690384
+TWR_MAX_RAW = int(300 / TWR_SCALE)
+
+# Node id pair tables for parse_final, rebuilt when assignments_version changes
+assignments_version = 0
+pair_left = None
+pair_right = None
+pair_version = -1
 
 # Error tracking globals
 parsing_error_count = 0
@@ -60,71 +151,62 @@ MAX_PARSING_ERRORS = 3
 # Rate limiting globals - thread-safe access
 import threading
 rate_limit_lock = threading.Lock()
+
+# MQTT v5 PUBACK reason code telling us nobody is subscribed to the topic. With
+# --mqtt-only-when-subscribed publishing is paused until no_subscribers_until.
+NO_MATCHING_SUBSCRIBERS = 16
+NO_SUBSCRIBERS_HOLDOFF = 30.0
+no_subscribers_until = 0.0
+
+# Set by on_mqtt_connect once the broker has accepted the connection
+mqtt_connected = threading.Event()
+MQTT_CONNECT_TIMEOUT = 5.0
 current_rate_limit = 10.0  # Will be set from args.mqtt_rate_limit
 
-def log_info(message):
-    """Always print important info unless in quiet mode"""
-    if not args.quiet:
-        print(message)
-
-def log_verbose(message):
-    """Only print in verbose mode"""
-    if args.verbose:
-        print(f"[VERBOSE] {message}")
-
-def log_warning(message):
-    """Always print warnings unless in quiet mode"""
-    if not args.quiet:
-        print(f"[WARNING] {message}")
-
-def log_error(message):
-    """Always print errors"""
-    print(f"[ERROR] {message}")
-
-def log_start(message):
-    """Always print startup messages"""
-    print(message)
-
-def on_mqtt_connect(client, userdata, flags, rc):
-    log_verbose(f"MQTT connect callback: flags={flags}, rc={rc}")
-    if rc == 0:
-        log_info(f"Connected to MQTT broker {args.mqtt_broker}:{args.mqtt_port}")
-        log_verbose("MQTT connection successful")
+# Token bucket - one token per publish, refilled at 1/current_rate_limit per second
+publish_tokens = 0.0  # Will be set from MQTT_BURST
+last_token_refill = time.monotonic()
+
+def on_mqtt_connect(client, userdata, flags, reason_code, properties):
+    logger.debug("MQTT connect callback: flags=%s, reason_code=%s", flags, reason_code)
+    if reason_code == 0:
+        logger.info("Connected to MQTT broker %s:%s", args.mqtt_broker, args.mqtt_port)
+        logger.debug("MQTT connection successful")
+        mqtt_connected.set()
         
         # Subscribe to command topic for rate limit updates
-        command_topic = f"{args.mqtt_topic}/cmd"
+        command_topic = f"{MQTT_TOPIC}/cmd"
         try:
             client.subscribe(command_topic, qos=1)
-            log_info(f"Subscribed to command topic: {command_topic}")
+            logger.info("Subscribed to command topic: %s", command_topic)
         except Exception as e:
-            log_error(f"Failed to subscribe to command topic: {e}")
+            logger.error("Failed to subscribe to command topic: %s", e)
     else:
-        error_messages = {
-            1: "Connection refused - incorrect protocol version",
-            2: "Connection refused - invalid client identifier",
-            3: "Connection refused - server unavailable",
-            4: "Connection refused - bad username or password",
-            5: "Connection refused - not authorised"
-        }
-        error_msg = error_messages.get(rc, f"Unknown error code {rc}")
-        log_error(f"Failed to connect to MQTT broker: {error_msg}")
-        log_verbose(f"MQTT connection failed with detailed error: {error_msg}")
-
-def on_mqtt_disconnect(client, userdata, rc):
-    log_verbose(f"MQTT disconnect callback: rc={rc}")
-    if rc != 0:
-        log_warning("Unexpected disconnection from MQTT broker")
-        log_verbose("MQTT unexpected disconnection")
+        # MQTT v5 reason codes carry a readable name, e.g. "Not authorized"
+        logger.error("Failed to connect to MQTT broker: %s", reason_code)
+        logger.debug("MQTT connection failed with detailed error: %r", reason_code)
+
+def on_mqtt_disconnect(client, userdata, disconnect_flags, reason_code, properties):
+    logger.debug("MQTT disconnect callback: reason_code=%s", reason_code)
+    mqtt_connected.clear()
+    if reason_code != 0:
+        logger.warning("Unexpected disconnection from MQTT broker")
+        logger.debug("MQTT unexpected disconnection")
     else:
-        log_info("Disconnected from MQTT broker")
-        log_verbose("MQTT clean disconnection")
+        logger.info("Disconnected from MQTT broker")
+        logger.debug("MQTT clean disconnection")
 
-def on_mqtt_publish(client, userdata, mid):
-    log_verbose(f"Message {mid} published to MQTT successfully")
+def on_mqtt_publish(client, userdata, mid, reason_code, properties):
+    global no_subscribers_until
+    logger.debug("Message %s published to MQTT: %s", mid, reason_code)
+    
+    # The broker acknowledged the message but nobody is listening on the topic
+    if reason_code == NO_MATCHING_SUBSCRIBERS and args.mqtt_only_when_subscribed:
+        no_subscribers_until = time.monotonic() + NO_SUBSCRIBERS_HOLDOFF
+        logger.info("No subscribers on '%s', pausing publishing for %ss", MQTT_TOPIC, NO_SUBSCRIBERS_HOLDOFF)
 
 def on_mqtt_log(client, userdata, level, buf):
-    if args.verbose:
-        print(f"[MQTT LOG] {buf}")
+    logger.debug("[MQTT LOG] %s", buf)
 
 def on_mqtt_message(client, userdata, message):
     """Handle incoming MQTT command messages"""
@@ -132,7 +214,7 @@ def on_mqtt_message(client, userdata, message):
         topic = message.topic
         payload = message.payload.decode('utf-8').strip()
         
-        log_verbose(f"Received command on {topic}: {payload}")
+        logger.debug("Received command on %s: %s", topic, payload)
         
         # Parse rate limit commands
         if payload.startswith('set rate_limit '):
@@ -143,133 +225,192 @@ def on_mqtt_message(client, userdata, message):
                     with rate_limit_lock:
                         old_rate = current_rate_limit
                         current_rate_limit = new_rate
-                    log_info(f"Updated rate limit: {old_rate}s → {new_rate}s")
+                    logger.info("Updated rate limit: %ss → %ss", old_rate, new_rate)
                 else:
-                    log_warning(f"Invalid rate limit value: {new_rate} (must be > 0)")
+                    logger.warning("Invalid rate limit value: %s (must be > 0)", new_rate)
             except (IndexError, ValueError) as e:
-                log_warning(f"Failed to parse rate limit command: {payload}")
+                logger.warning("Failed to parse rate limit command: %s", payload)
         else:
-            log_verbose(f"Unknown command: {payload}")
+            logger.debug("Unknown command: %s", payload)
             
     except Exception as e:
-        log_error(f"Error processing MQTT command: {e}")
+        logger.error("Error processing MQTT command: %s", e)
 
 def setup_mqtt():
-    global mqtt_client, current_rate_limit
+    global mqtt_client, current_rate_limit, publish_tokens, publish_thread
     
-    if args.disable_mqtt:
-        log_verbose("MQTT disabled via command line argument")
+    if DISABLE_MQTT:
+        logger.debug("MQTT disabled via command line argument")
         return None
         
-    # Initialize current rate limit from command line argument
+    # Initialize current rate limit and a full token bucket from command line arguments
     current_rate_limit = args.mqtt_rate_limit
+    publish_tokens = MQTT_BURST
     
-    if args.disable_mqtt:
-        log_verbose("MQTT disabled via command line argument")
+    if DISABLE_MQTT:
+        logger.debug("MQTT disabled via command line argument")
         return None
         
     try:
-        log_verbose("Creating MQTT client instance")
-        mqtt_client = mqtt.Client()
+        logger.debug("Creating MQTT client instance")
+        mqtt_client = mqtt.Client(
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+            protocol=mqtt.MQTTv5
+        )
         
         # Set up callbacks
         mqtt_client.on_connect = on_mqtt_connect
         mqtt_client.on_disconnect = on_mqtt_disconnect
-        mqtt_client.on_publish = on_mqtt_publish
+        if MQTT_QOS > 0:
+            # Only acknowledged publishes produce a meaningful delivery callback
+            mqtt_client.on_publish = on_mqtt_publish
         mqtt_client.on_log = on_mqtt_log
         mqtt_client.on_message = on_mqtt_message
         
-        log_verbose(f"Configuring SSL for broker {args.mqtt_broker}:{args.mqtt_port}")
+        logger.debug("Configuring SSL for broker %s:%s", args.mqtt_broker, args.mqtt_port)
         
         # Configure SSL
-        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-        context.check_hostname = False
-        context.verify_mode = ssl.CERT_NONE
-        
-        log_verbose(f"SSL context created - check_hostname={context.check_hostname}, verify_mode={context.verify_mode}")
+        logger.debug("SSL context - check_hostname=%s, verify_mode=%s", tls_context.check_hostname, tls_context.verify_mode)
         
-        mqtt_client.tls_set_context(context)
-        log_verbose("SSL context applied to MQTT client")
+        mqtt_client.tls_set_context(tls_context)
+        mqtt_client.tls_insecure_set(args.mqtt_insecure)
+        logger.debug("SSL context applied to MQTT client")
         
         # Connect to broker
-        log_verbose(f"Attempting to connect to {args.mqtt_broker}:{args.mqtt_port}")
+        logger.debug("Attempting to connect to %s:%s", args.mqtt_broker, args.mqtt_port)
         connect_result = mqtt_client.connect(args.mqtt_broker, args.mqtt_port, 60)
-        log_verbose(f"Connect call returned: {connect_result}")
+        logger.debug("Connect call returned: %s", connect_result)
         
-        log_verbose("Starting MQTT client loop")
+        logger.debug("Starting MQTT client loop")
         mqtt_client.loop_start()
         
-        # Wait a moment for connection to establish
-        time.sleep(2)
-        
-        if mqtt_client.is_connected():
-            log_verbose("MQTT client reports connected status")
+        # Wait for the connect callback rather than a fixed delay
+        if mqtt_connected.wait(timeout=MQTT_CONNECT_TIMEOUT):
+            logger.debug("MQTT client reports connected status")
         else:
-            log_verbose("MQTT client reports disconnected status after 2 seconds")
+            logger.debug("MQTT client reports disconnected status after %s seconds", MQTT_CONNECT_TIMEOUT)
         
-        log_info(f"MQTT client configured for {args.mqtt_broker}:{args.mqtt_port}")
+        logger.debug("Starting MQTT publish worker")
+        publish_thread = threading.Thread(target=mqtt_publish_worker, daemon=True)
+        publish_thread.start()
+        
+        logger.info("MQTT client configured for %s:%s", args.mqtt_broker, args.mqtt_port)
         return mqtt_client
         
     except Exception as e:
-        log_error(f"Failed to setup MQTT: {e}")
-        log_verbose(f"MQTT setup exception details: {type(e).__name__}: {str(e)}")
-        import traceback
-        if args.verbose:
-            traceback.print_exc()
+        logger.error("Failed to setup MQTT: %s", e)
+        logger.debug("MQTT setup exception details: %s: %s", type(e).__name__, e, exc_info=True)
         return None
 
 def publish_to_mqtt(data):
-    global mqtt_client, last_publish_time
+    global batch_started
     
     if mqtt_client is None:
-        log_info("MQTT publish skipped - client not available")
+        logger.info("MQTT publish skipped - client not available")
         return
         
-    if args.disable_mqtt:
-        log_verbose("MQTT publish skipped - disabled via command line")
+    if DISABLE_MQTT:
+        logger.debug("MQTT publish skipped - disabled via command line")
+        return
+    
+    if no_subscribers_until and time.monotonic() < no_subscribers_until:
+        logger.debug("MQTT publish skipped - no subscribers")
+        return
+    
+    # Collect frames until the batch is full, stale batches are flushed from the main loop
+    if not pending_batch:
+        batch_started = time.monotonic()
+    pending_batch.append(data)
+    
+    if len(pending_batch) < MQTT_BATCH_SIZE:
+        logger.debug("Batched frame %s/%s", len(pending_batch), MQTT_BATCH_SIZE)
+        return
+    
+    flush_mqtt_batch()
+
+def flush_stale_mqtt_batch():
+    """Publish a partial batch once it has been held for the batch interval"""
+    if pending_batch and time.monotonic() - batch_started >= MQTT_BATCH_INTERVAL:
+        flush_mqtt_batch()
+
+def mqtt_batch_wait():
+    """Seconds the main loop may sleep before the pending batch goes stale"""
+    if not pending_batch:
+        return 1.0
+    return min(1.0, max(0.0, batch_started + MQTT_BATCH_INTERVAL - time.monotonic()))
+
+def flush_mqtt_batch():
+    global pending_batch, publish_tokens, last_token_refill
+    
+    if not pending_batch:
         return
-        
-    current_time = time.time()
-    time_since_last = current_time - last_publish_time
     
     # Get current rate limit in thread-safe manner
     with rate_limit_lock:
         rate_limit = current_rate_limit
     
-    if time_since_last < rate_limit:
-        log_info(f"MQTT publish rate limited - waiting {rate_limit - time_since_last:.1f}s more")
+    # Refill the token bucket for the time elapsed since the last message
+    now = time.monotonic()
+    publish_tokens = min(MQTT_BURST, publish_tokens + (now - last_token_refill) / rate_limit)
+    last_token_refill = now
+    
+    # Each MQTT message costs one token, however many frames it carries
+    if publish_tokens < 1:
+        logger.info("MQTT publish rate limited - dropping %s frame(s), waiting %.1fs more",
+                    len(pending_batch), (1 - publish_tokens) * rate_limit)
+        pending_batch = []
         return
         
     if not mqtt_client.is_connected():
-        log_info("MQTT client not connected, skipping publish")
+        logger.info("MQTT client not connected, skipping publish")
+        pending_batch = []
         return
+    
+    publish_tokens -= 1
+    
+    # Single frames keep the plain array format, batches are wrapped with a timestamp
+    if MQTT_BATCH_SIZE > 1:
+        data = {"ts": time.time(), "frames": pending_batch}
+    else:
+        data = pending_batch[0]
+    pending_batch = []
         
+    # Encode data as JSON and hand it to the publish worker
+    payload = encode_payload(data)
+    if VERBOSE:
+        logger.debug("Queueing publish to topic '%s': %s", MQTT_TOPIC, payload.decode(errors='replace'))
+    
     try:
-        # Convert data to JSON string with proper formatting
-        json_data = json.dumps(data)
-        log_verbose(f"Attempting to publish to topic '{args.mqtt_topic}': {json_data}")
-        
-        result = mqtt_client.publish(args.mqtt_topic, json_data, qos=1)
-        log_verbose(f"Publish result: rc={result.rc}, mid={result.mid}")
+        publish_queue.put_nowait(payload)
+    except queue.Full:
+        logger.warning("MQTT publish queue full, dropping message")
+
+def mqtt_publish_worker():
+    """Publish queued payloads so the serial loop never waits on the network"""
+    while True:
+        payload = publish_queue.get()
+        if payload is None:
+            break
         
-        if result.rc == mqtt.MQTT_ERR_SUCCESS:
-            last_publish_time = current_time
-            log_info(f"Published to MQTT topic '{args.mqtt_topic}': {json_data}")
-        else:
-            error_messages = {
-                mqtt.MQTT_ERR_NO_CONN: "No connection to broker",
-                mqtt.MQTT_ERR_QUEUE_SIZE: "Message queue full",
-                mqtt.MQTT_ERR_PAYLOAD_SIZE: "Payload too large"
-            }
-            error_msg = error_messages.get(result.rc, f"Unknown error {result.rc}")
-            log_info(f"Failed to publish to MQTT: {error_msg}")
+        try:
+            result = mqtt_client.publish(MQTT_TOPIC, payload, qos=MQTT_QOS)
+            logger.debug("Publish result: rc=%s, mid=%s", result.rc, result.mid)
             
-    except Exception as e:
-        log_info(f"Error publishing to MQTT: {e}")
-        log_verbose(f"MQTT publish exception: {type(e).__name__}: {str(e)}")
-        if args.verbose:
-            import traceback
-            traceback.print_exc()
+            if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                if not QUIET:
+                    logger.info("Published to MQTT topic '%s': %s", MQTT_TOPIC, payload.decode(errors='replace'))
+            else:
+                error_messages = {
+                    mqtt.MQTT_ERR_NO_CONN: "No connection to broker",
+                    mqtt.MQTT_ERR_QUEUE_SIZE: "Message queue full",
+                    mqtt.MQTT_ERR_PAYLOAD_SIZE: "Payload too large"
+                }
+                error_msg = error_messages.get(result.rc, f"Unknown error {result.rc}")
+                logger.info("Failed to publish to MQTT: %s", error_msg)
+                
+        except Exception as e:
+            logger.info("Error publishing to MQTT: %s", e)
+            logger.debug("MQTT publish exception: %s: %s", type(e).__name__, e, exc_info=True)
 
 def connect(uart):
     try:
@@ -284,11 +425,11 @@ def connect(uart):
         ser.dtr = False
         
     except serial.SerialException as e:
-        log_error(f"Serial connection failed: {e}")
+        logger.error("Serial connection failed: %s", e)
         return 0
     
     time.sleep(0.5)
-    log_verbose(f"Serial connection established: {ser.read(ser.in_waiting)}")
+    logger.debug("Serial connection established: %s", ser.read(ser.in_waiting))
 
     return ser
 
@@ -304,96 +445,85 @@ def flush_rx(ser):
         return msg
         
     except serial.SerialException as e:
-        log_error(f"Serial read error: {e}")
+        logger.error("Serial read error: %s", e)
         disconnect(ser)
         return b''
 
 def reset(ser):
     global parsing_error_count
-    log_info("Resetting device...")
+    logger.info("Resetting device...")
     ser.dtr = True
     time.sleep(0.1)
     ser.dtr = False
     parsing_error_count = 0  # Reset error counter after device reset
 
-def write(d, data):
-    s = str(bytearray(data)) if sys.version_info<(3,) else bytes(data)
-    return d.write(s)
-
-def read(d, nbytes):
-    s = d.read(nbytes)
-    return [ord(c) for c in s] if type(s) is str else list(s)
-
-def twr_value_ok(value):
-    return value > 0 and 0.004690384 * value < 300
-
 def handle_parsing_error(error_msg):
     global parsing_error_count
     parsing_error_count += 1
-    log_warning(f"Packet parsing error ({parsing_error_count}/{MAX_PARSING_ERRORS}): {error_msg}")
+    logger.warning("Packet parsing error (%s/%s): %s", parsing_error_count, MAX_PARSING_ERRORS, error_msg)
     
     if parsing_error_count >= MAX_PARSING_ERRORS:
-        log_warning(f"Maximum parsing errors reached ({MAX_PARSING_ERRORS}), resetting device...")
+        logger.warning("Maximum parsing errors reached (%s), resetting device...", MAX_PARSING_ERRORS)
         return True  # Signal that reset is needed
     return False
 
-def parse_final(assignments, final_payload, mode=0):
+@functools.lru_cache(maxsize=16)
+def pair_index_tables(g1, g2, g3, mode):
+    """Positions in the flattened assignments of both nodes for each TOF value"""
+    starts = (0, g1, g1 + g2)
+    sizes = (g1, g2, g3)
+
+    # TOF values are transmitted as g1 x g2, g1 x g3, g2 x g3,
+    # then the optional g1 / g2 internal triangles
+    left = []
+    right = []
+    for a, b in ((0, 1), (0, 2), (1, 2)):
+        i, j = np.meshgrid(np.arange(sizes[a]), np.arange(sizes[b]), indexing='ij')
+        left.append(i.ravel() + starts[a])
+        right.append(j.ravel() + starts[b])
+    for bit, a in ((1, 0), (2, 1)):
+        if mode & bit:
+            i, j = np.triu_indices(sizes[a], 1)
+            left.append(i + starts[a])
+            right.append(j + starts[a])
+
+    # The tables are shared between calls, so protect them from modification
+    left = np.concatenate(left)
+    right = np.concatenate(right)
+    left.flags.writeable = False
+    right.flags.writeable = False
+    return left, right
+
+def build_pair_tables(assignments, mode):
+    if len(assignments) != 3:
+        raise ValueError("No node assignments received yet")
+
+    left, right = pair_index_tables(len(assignments[0]), len(assignments[1]), len(assignments[2]), mode)
+    nodes = np.array(assignments[0] + assignments[1] + assignments[2], dtype=np.uint16)
+    return nodes[left], nodes[right]
+
+def parse_final(assignments, final_payload, mode=0, offset=0):
+    global pair_left, pair_right, pair_version
     results = []
 
-    if len(final_payload) == 0:
+    if len(final_payload) <= offset:
         return results
     
     try:
-        idx = 0
-
-        for i in range(0, len(assignments[0])):
-            for j in range(0, len(assignments[1])):
-                if idx + 2 > len(final_payload):
-                    raise ValueError("Insufficient payload data for assignments[0] x assignments[1]")
-                value = struct.unpack('<H', final_payload[idx:(idx+2)])[0]
-                idx += 2
-                if (twr_value_ok(value)):
-                    results.append([assignments[0][i], assignments[1][j], 0.004690384 * (value)])
-        
-        for i in range(0, len(assignments[0])):
-            for j in range(0, len(assignments[2])):
-                if idx + 2 > len(final_payload):
-                    raise ValueError("Insufficient payload data for assignments[0] x assignments[2]")
-                value = struct.unpack('<H', final_payload[idx:(idx+2)])[0]
-                idx += 2
-                if (twr_value_ok(value)):
-                    results.append([assignments[0][i], assignments[2][j], 0.004690384 * (value)])
-
-        for i in range(0, len(assignments[1])):
-            for j in range(0, len(assignments[2])):
-                if idx + 2 > len(final_payload):
-                    raise ValueError("Insufficient payload data for assignments[1] x assignments[2]")
-                value = struct.unpack('<H', final_payload[idx:(idx+2)])[0]
-                idx += 2
-                if (twr_value_ok(value)):
-                    results.append([assignments[1][i], assignments[2][j], 0.004690384 * (value)])
-
-        if mode & 1:
-            for i in range(0, len(assignments[0])):
-                for j in range(i+1, len(assignments[0])):
-                    if idx + 2 > len(final_payload):
-                        raise ValueError("Insufficient payload data for assignments[0] internal")
-                    value = struct.unpack('<H', final_payload[idx:(idx+2)])[0]
-                    idx += 2
-                    if (twr_value_ok(value)):
-                        results.append([assignments[0][i], assignments[0][j], 0.004690384 * (value)])
-        
-        if mode & 2:
-            for i in range(0, len(assignments[1])):
-                for j in range(i+1, len(assignments[1])):
-                    if idx + 2 > len(final_payload):
-                        raise ValueError("Insufficient payload data for assignments[1] internal")
-                    value = struct.unpack('<H', final_payload[idx:(idx+2)])[0]
-                    idx += 2
-                    if (twr_value_ok(value)):
-                        results.append([assignments[1][i], assignments[1][j], 0.004690384 * (value)])
+        if pair_version != assignments_version:
+            pair_left, pair_right = build_pair_tables(assignments, mode)
+            pair_version = assignments_version
+
+        if 2 * len(pair_left) > len(final_payload) - offset:
+            raise ValueError(f"Insufficient payload data for {len(pair_left)} TOF values")
+
+        values = np.frombuffer(final_payload, dtype='<u2', count=len(pair_left), offset=offset)
+        mask = (values > 0) & (values <= TWR_MAX_RAW)
+        distances = values[mask] * TWR_SCALE
+
+        results = [list(item) for item in zip(pair_left[mask].tolist(), pair_right[mask].tolist(), distances.tolist())]
                     
-    except (struct.error, ValueError, IndexError) as e:
+    except (ValueError, IndexError) as e:
         if handle_parsing_error(f"parse_final: {str(e)}"):
             raise Exception("RESET_REQUIRED")
         return []
@@ -403,89 +533,75 @@ def parse_final(assignments, final_payload, mode=0):
 def print_list(results):
     if len(results) == 0:
         return
+
+    if DISABLE_MQTT and not VERBOSE:
+        return
         
     # Format data for both display and MQTT publishing
     formatted_data = []
-    row = "[ "
+    parts = []
     
     for item in results:
-        # Create formatted entry for MQTT (with quoted node IDs)
-        mqtt_entry = ["{:04X}".format(item[0]), "{:04X}".format(item[1]), round(item[2], 3)]
-        formatted_data.append(mqtt_entry)
+        # Format each node ID once and share it between MQTT and display
+        node1 = "{:04X}".format(item[0])
+        node2 = "{:04X}".format(item[1])
+        formatted_data.append([node1, node2, round(item[2], 3)])
         
-        # Create display string
-        row += "[\"{:04X}\",".format( item[0] )
-        row += "\"{:04X}\",".format( item[1] )
-        row += "{: <3.3f}], ".format( item[2] )
-        
-    row = row[:-2]
-    row += " ]"
+        if VERBOSE:
+            parts.append("[\"{}\",\"{}\",{: <3.3f}]".format(node1, node2, item[2]))
     
     # Only show parsed data in verbose mode
-    log_verbose(f"Parsed data: {row}")
+    if VERBOSE:
+        logger.debug("Parsed data: [ %s ]", ", ".join(parts))
     
     # Publish to MQTT
     publish_to_mqtt(formatted_data)
 
 def print_matrix(assignments, results):
-    if not args.verbose:
+    if not VERBOSE:
         return
         
-    nodes = []
-    for a in assignments:
-        for node in a:
-            nodes.append(node)
+    nodes = [node for a in assignments for node in a]
+    
+    # First position of each node id, matching the old nodes.index() lookup
+    node_index = {}
+    for i, node in enumerate(nodes):
+        node_index.setdefault(node, i)
         
-    result_matrix = []
-    for i in range(0, len(nodes)):
-        row = []
-        for j in range(0, len(nodes)):
-            row.append(-1)
-        result_matrix.append(row)
+    result_matrix = np.full((len(nodes), len(nodes)), -1.0)
+    for node1, node2, distance in results:
+        result_matrix[node_index[node1], node_index[node2]] = distance
 
-        
-    for result in results:
-        i = nodes.index(result[0])
-        j = nodes.index(result[1])
-        result_matrix[i][j] = result[2]
-
-    row = "        "
-    for node in nodes:
-        row += "{:04X}    ".format( node )
-    log_verbose(row)
-
-    rowIdx = 0  
-    for lst in result_matrix:
-        row = "{:04X}    ".format( nodes[rowIdx] )
-        rowIdx = rowIdx + 1
-        for item in lst:
-            if item == -1:
-                row += "        "
-            else:
-                row += "{: <8.3f}".format( item )
-        log_verbose(row)
+    logger.debug("        " + "".join("{:04X}    ".format(node) for node in nodes))
+
+    for node, lst in zip(nodes, result_matrix.tolist()):
+        row = "{:04X}    ".format(node)
+        row += "".join("        " if item == -1 else "{: <8.3f}".format(item) for item in lst)
+        logger.debug(row)
 
 # Print startup information
-log_start("UWB MQTT Publisher Starting...")
-log_start(f"Serial port: {args.uart}")
-log_start(f"MQTT broker: {args.mqtt_broker}:{args.mqtt_port}")
-log_start(f"MQTT topic: {args.mqtt_topic}")
-log_start(f"MQTT command topic: {args.mqtt_topic}/cmd")
-log_start(f"Initial rate limit: {args.mqtt_rate_limit}s")
-if args.quiet:
-    log_start("Quiet mode enabled - minimal logging")
-elif args.verbose:
-    log_start("Verbose mode enabled - detailed logging")
+logger.log(STARTUP, "UWB MQTT Publisher Starting...")
+logger.log(STARTUP, "Serial port: %s", args.uart)
+logger.log(STARTUP, "MQTT broker: %s:%s", args.mqtt_broker, args.mqtt_port)
+logger.log(STARTUP, "MQTT topic: %s", MQTT_TOPIC)
+logger.log(STARTUP, "MQTT command topic: %s/cmd", MQTT_TOPIC)
+logger.log(STARTUP, "Initial rate limit: %ss", args.mqtt_rate_limit)
+if QUIET:
+    logger.log(STARTUP, "Quiet mode enabled - minimal logging")
+elif VERBOSE:
+    logger.log(STARTUP, "Verbose mode enabled - detailed logging")
+if args.mqtt_only_when_subscribed and MQTT_QOS == 0:
+    logger.warning("--mqtt-only-when-subscribed has no effect with QoS 0, the broker only reports subscribers in PUBACKs")
 
 # Initialize MQTT
-log_verbose("Initializing MQTT client...")
+logger.debug("Initializing MQTT client...")
 mqtt_client = setup_mqtt()
 
-log_verbose(f"Connecting to serial port {args.uart}")
+logger.debug("Connecting to serial port %s", args.uart)
 ser = connect(args.uart)
 
 if not ser:
-    log_error("Failed to connect to serial port")
+    logger.error("Failed to connect to serial port")
     sys.exit(1)
 
 reset(ser)
@@ -495,15 +611,15 @@ ser.reset_input_buffer()
 if False:
     ser.write([0xdc, 0xac, 1, 0, ord('w')])
     time.sleep(0.5)
-    log_verbose(f"Write response: {flush_rx(ser)}")
+    logger.debug("Write response: %s", flush_rx(ser))
 
 ser.write([0xdc, 0xac, 1, 0, ord('s')])
 
 if False:
     time.sleep(0.5)
-    log_verbose(f"Start response: {flush_rx(ser)}")
+    logger.debug("Start response: %s", flush_rx(ser))
 
-s = []
+buf = bytearray()
 
 assignments = []
 tof_list = []
@@ -514,133 +630,174 @@ g2 = 0
 g3 = 0
 unassigned_count = 0
 
-log_start("Data processing started...")
+# Wait for serial data with select/epoll where the port exposes a file descriptor,
+# otherwise fall back to polling in_waiting with a short sleep (e.g. on Windows)
+try:
+    selector = selectors.DefaultSelector()
+    selector.register(ser.fileno(), selectors.EVENT_READ)
+except (AttributeError, OSError, ValueError):
+    selector = None
+logger.debug("Serial wait mode: %s", "selector" if selector else "polling")
+
+logger.log(STARTUP, "Data processing started...")
+
+exit_code = 0
 
 try:
     while(1):
 
-        cnt = ser.in_waiting
-        if cnt > 0:
-            newS = read(ser, 1)
-            
-            s = s + newS
-            
-            while len(s) >= 4:
-                try:
-                    if s[0] == 0xDC and  s[1] == 0xAC:
-                        l = struct.unpack('<H', bytes(s[2:4]))[0]
-
-                        payload = read(ser, l)
-                        s = []
-                        idx = 0
+        try:
+            if selector:
+                # Sleep in the kernel until the UART has data or the pending batch goes stale
+                if not selector.select(timeout=mqtt_batch_wait()):
+                    flush_stale_mqtt_batch()
+                    continue
+                data = ser.read(ser.in_waiting or 1)
+            else:
+                cnt = ser.in_waiting
+                if cnt == 0:
+                    flush_stale_mqtt_batch()
+                    time.sleep(0.001)
+                    continue
+                data = ser.read(cnt)
+        except (serial.SerialException, OSError) as e:
+            logger.error("Serial read error: %s", e)
+            exit_code = 1
+            break
+        buf += data
+        # A steady trickle of frames never hits the idle timeout, so check here too
+        flush_stale_mqtt_batch()
+        
+        while len(buf) >= 4:
+            try:
+                i = buf.find(b'\xDC\xAC')
+                if i == 0:
+                    l = struct.unpack_from('<H', buf, 2)[0]
+
+                    if len(buf) < 4 + l:
+                        # wait for the rest of the packet to arrive
+                        break
+
+                    payload = bytes(buf[4:4 + l])
+                    del buf[:4 + l]
+                    idx = 0
+                    
+                    if len(payload) < 4:
+                        raise ValueError("Payload too short")
                         
-                        if len(payload) < 4:
-                            raise ValueError("Payload too short")
-                            
-                        [act_type, act_slot, timeframe] = struct.unpack('<BbH', bytes(payload[idx:(idx+4)]))
-                        log_verbose(f"act_type: {hex(act_type)}: {act_slot}/{timeframe}")
-                        idx = idx + 4
-
-                        if (payload[0] == 2):
-                            assignments = []
-                            if len(payload) < idx + 5:
-                                raise ValueError("Assignment payload too short")
-                                
-                            [tx_pwr, mode, g1, g2, g3] = struct.unpack('<BBBBB', bytes(payload[idx:(idx+5)]))
-
-                            log_verbose(f"mode: {hex(mode)}: {g1}/{g2}/{g3}")
-
-                            idx = idx + 5
-                            group1 = []
-                            for i in range(0, g1):
-                                if idx + 2 > len(payload):
-                                    raise ValueError("Group1 data incomplete")
-                                group1.append(struct.unpack('<H', bytes(payload[idx:(idx+2)]))[0])
-                                idx = idx + 2
-                            group2 = []
-                            for i in range(0, g2):
-                                if idx + 2 > len(payload):
-                                    raise ValueError("Group2 data incomplete")
-                                group2.append(struct.unpack('<H', bytes(payload[idx:(idx+2)]))[0])
-                                idx = idx + 2
-                            group3 = []
+                    [act_type, act_slot, timeframe] = struct.unpack_from('<BbH', payload, idx)
+                    if VERBOSE:
+                        logger.debug("act_type: %s: %s/%s", hex(act_type), act_slot, timeframe)
+                    idx = idx + 4
+
+                    if (payload[0] == 2):
+                        assignments = []
+                        if len(payload) < idx + 5:
+                            raise ValueError("Assignment payload too short")
                             
-                            unassigned_count = 0
-                            for i in range(0, g3):
-                                if idx + 2 > len(payload):
-                                    raise ValueError("Group3 data incomplete")
-                                id = struct.unpack('<H', bytes(payload[idx:(idx+2)]))[0]
-                                if id == 0:
-                                    unassigned_count = unassigned_count + 1
-                                group3.append(id)
-                                idx = idx + 2
-                            assignments = [group1, group2, group3]
+                        [tx_pwr, mode, g1, g2, g3] = struct.unpack_from('<BBBBB', payload, idx)
+
+                        if VERBOSE:
+                            logger.debug("mode: %s: %s/%s/%s", hex(mode), g1, g2, g3)
+
+                        idx = idx + 5
+                        if idx + 2 * (g1 + g2 + g3) > len(payload):
+                            raise ValueError("Group data incomplete")
+
+                        ids = struct.unpack_from(f'<{g1 + g2 + g3}H', payload, idx)
+                        group1 = list(ids[:g1])
+                        group2 = list(ids[g1:g1 + g2])
+                        group3 = list(ids[g1 + g2:])
+                        unassigned_count = group3.count(0)
+                        assignments = [group1, group2, group3]
+                        assignments_version += 1
 
-                            log_verbose(f"Assignments: {assignments}")
+                        if VERBOSE:
+                            logger.debug("Assignments: %s", assignments)
 
-                        if (payload[0] == 4):
-                            tof_list = []
+                    if (payload[0] == 4):
+                        tof_list = []
 
-                            tof_count = g1 * g2 + g1 * g3 + g2 * g3
-                            if mode & 1:
-                                tof_count = tof_count + g1 * (g1-1) / 2
-                            if mode & 2:
-                                tof_count = tof_count + g2 * (g2-1) / 2
+                        tof_count = g1 * g2 + g1 * g3 + g2 * g3
+                        if mode & 1:
+                            tof_count = tof_count + g1 * (g1-1) / 2
+                        if mode & 2:
+                            tof_count = tof_count + g2 * (g2-1) / 2
 
-                            tof_count = int(tof_count)
+                        tof_count = int(tof_count)
 
-                            log_verbose(f"tof_count = {tof_count}")
-                            log_verbose(f"unassigned_count = {unassigned_count}")
+                        if VERBOSE:
+                            logger.debug("tof_count = %s", tof_count)
+                            logger.debug("unassigned_count = %s", unassigned_count)
 
-                            ii = (idx+tof_count*2)
+                        ii = (idx+tof_count*2)
 
-                            new_assignments = []
+                        new_assignments = []
 
-                            for i in range(0, unassigned_count):
-                                if ii + 2 > len(payload):
-                                    raise ValueError("New assignments data incomplete")
-                                id = struct.unpack('<H', bytes(payload[ii:(ii+2)]))[0]
-                                ii = ii + 2
-                                new_assignments.append(id)
+                        for i in range(0, unassigned_count):
+                            if ii + 2 > len(payload):
+                                raise ValueError("New assignments data incomplete")
+                            id = struct.unpack_from('<H', payload, ii)[0]
+                            ii = ii + 2
+                            new_assignments.append(id)
 
+                            if assignments[2][g3-unassigned_count+i] != id:
                                 assignments[2][g3-unassigned_count+i] = id
+                                assignments_version += 1
 
-                            log_verbose(f"Updated assignments: {assignments}")
+                        if VERBOSE:
+                            logger.debug("Updated assignments: %s", assignments)
 
-                            results = parse_final(assignments, bytes(payload[idx:]), mode)
+                        results = parse_final(assignments, payload, mode, idx)
 
-                            print_matrix(assignments, results)
-                            print_list(results)
+                        print_matrix(assignments, results)
+                        print_list(results)
 
-                    else:
-                        # not a start of packet, needs re-aligning
-                        log_verbose(f'Realigning: thrash {hex(s[0])}: {chr((s[0])) if 32 <= s[0] <= 126 else "?"}')
-                        s = s[1:]
-                        
-                except Exception as e:
-                    if str(e) == "RESET_REQUIRED":
+                else:
+                    # not a start of packet, skip straight to the next header candidate
+                    if i < 0:
+                        # no header at all - keep a trailing 0xDC as it may start the next one
+                        i = len(buf) - 1 if buf[-1] == 0xDC else len(buf)
+                    if VERBOSE:
+                        logger.debug("Realigning: thrash %s bytes: %s", i, bytes(buf[:i]))
+                    del buf[:i]
+                    
+            except Exception as e:
+                if str(e) == "RESET_REQUIRED":
+                    reset(ser)
+                    ser.reset_input_buffer()
+                    buf.clear()
+                    assignments = []
+                    assignments_version += 1
+                    continue
+                else:
+                    if handle_parsing_error(f"Packet processing: {str(e)}"):
                         reset(ser)
                         ser.reset_input_buffer()
-                        s = []
+                        buf.clear()
                         assignments = []
+                        assignments_version += 1
                         continue
-                    else:
-                        if handle_parsing_error(f"Packet processing: {str(e)}"):
-                            reset(ser)
-                            ser.reset_input_buffer()
-                            s = []
-                            assignments = []
-                            continue
 
 except KeyboardInterrupt:
-    log_start("\nShutting down...")
-    log_verbose("Keyboard interrupt received, cleaning up...")
-    if mqtt_client:
-        log_verbose("Stopping MQTT client loop...")
-        mqtt_client.loop_stop()
-        log_verbose("Disconnecting from MQTT broker...")
-        mqtt_client.disconnect()
-    log_verbose("Disconnecting from serial port...")
+    logger.log(STARTUP, "\nShutting down...")
+    logger.debug("Keyboard interrupt received, cleaning up...")
+
+if mqtt_client:
+    logger.debug("Publishing any pending MQTT batch...")
+    flush_mqtt_batch()
+    if publish_thread:
+        logger.debug("Waiting for queued MQTT publishes...")
+        publish_queue.put(None)
+        publish_thread.join(timeout=5)
+    logger.debug("Stopping MQTT client loop...")
+    mqtt_client.loop_stop()
+    logger.debug("Disconnecting from MQTT broker...")
+    mqtt_client.disconnect()
+logger.debug("Disconnecting from serial port...")
+try:
     disconnect(ser)
-    log_verbose("Cleanup complete, exiting...")
-    sys.exit(0)
\ No newline at end of file
+except (serial.SerialException, OSError) as e:
+    logger.debug("Serial port already gone: %s", e)
+logger.debug("Cleanup complete, exiting...")
+sys.exit(exit_code)
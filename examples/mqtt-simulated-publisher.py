@@ -5,6 +5,10 @@ Dynamic Devices Ltd - Example code for inst-visualiser v3.6
 
 Requirements:
     pip install paho-mqtt numpy
+    pip install msgpack  # optional, for --format msgpack
+    pip install numba    # optional, compiles the distance kernel
+    pip install orjson   # optional, faster JSON encoding
+    pip install uvloop   # optional, faster event loop (not on Windows)
 
 Usage:
     python mqtt-publisher.py --broker test.mosquitto.org --topic uwb/test
@@ -12,15 +16,46 @@ Usage:
 
 import json
 import time
-import random
+import secrets
 import math
 import argparse
+import asyncio
 import logging
 import signal
+import socket
 import sys
 import threading
 from typing import List, Tuple, Optional
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+import numpy as np
+
+# Numba compiles the pairwise distance kernel when available, otherwise NumPy is used
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# orjson is optional - it encodes several times faster and returns bytes that paho sends as-is
+try:
+    import orjson
+    encode_json = orjson.dumps
+except ImportError:
+    def encode_json(data):
+        return json.dumps(data).encode()
+
+# uvloop is optional - a faster libuv-based event loop where available (not on Windows)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+# MessagePack is only needed for --format msgpack
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Configure logging
 logging.basicConfig(
@@ -32,13 +67,39 @@ logger = logging.getLogger(__name__)
 class UWBPublisher:
     """MQTT publisher for UWB positioning data - Compatible with paho-mqtt v2.0+"""
     
-    def __init__(self, broker: str, port: int, topic: str, client_id: str = None):
+    BACKPRESSURE_INTERVAL = 16
+    RECONNECT_DELAY = 5.0
+    
+    def __init__(self, broker: str, port: int, topic: str, client_id: str = None,
+                 payload_format: str = "json", qos: int = 0,
+                 topics_count: int = 1, topic_prefix: Optional[str] = None):
         self.broker = broker
         self.port = port
         self.topic = topic
         self.command_topic = f"{topic}/cmd"
-        self.client_id = client_id or f"uwb_publisher_{random.randint(1000, 9999)}"
+        self.payload_format = payload_format
+        # Each measurement set supersedes the last, so QoS 0 avoids a PUBACK round-trip per publish
+        self.qos = qos
+        # Node pairs repeat every tick, so their JSON prefixes are rendered once and cached
+        self._json_prefixes = {}
+        # MessagePack goes to a companion topic so JSON consumers such as the visualiser are unaffected
+        self.data_topic = f"{topic}.msgpack" if payload_format == "msgpack" else topic
+        self.format_topic = f"{self.data_topic}/format"
+        # Fan-out publishes every message to topics_count numbered topics for broker benchmarking
+        if topics_count > 1:
+            prefix = topic_prefix if topic_prefix is not None else f"{self.data_topic}/"
+            self.data_topics = [f"{prefix}{i}" for i in range(topics_count)]
+        else:
+            self.data_topics = [self.data_topic]
+        # MQTT v5 topic aliases granted by the broker, reset on every connection
+        self._topic_aliases = {}
+        self._topic_alias_max = 0
+        # Every BACKPRESSURE_INTERVAL-th QoS 1/2 publish waits for its acknowledgement
+        self._publish_count = 0
+        self.client_id = client_id or f"uwb_publisher_{secrets.token_hex(2)}"
         self.client = None
+        self._loop = None
+        self._misc_task = None
         self.connected = False
         self.running = False
         self.rate_limit_lock = threading.Lock()
@@ -49,7 +110,22 @@ class UWBPublisher:
         if rc == 0:
             self.connected = True
             logger.info(f"Connected to MQTT broker {self.broker}:{self.port}")
-            logger.info(f"Publishing to topic: {self.topic}")
+            
+            # Aliases only live for one connection and the broker limits how many we may use
+            self._topic_aliases = {}
+            self._topic_alias_max = getattr(properties, "TopicAliasMaximum", 0) if properties else 0
+            
+            # Small periodic publishes should go out immediately rather than wait for Nagle coalescing
+            sock = client.socket()
+            if sock is not None:
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                except OSError as e:
+                    logger.debug("Could not set TCP_NODELAY: %s", e)
+            if len(self.data_topics) > 1:
+                logger.info(f"Publishing to {len(self.data_topics)} topics: {self.data_topics[0]} ... {self.data_topics[-1]}")
+            else:
+                logger.info(f"Publishing to topic: {self.data_topic}")
             
             # Subscribe to command topic for rate limit updates
             try:
@@ -67,7 +143,7 @@ class UWBPublisher:
         
     def on_publish(self, client, userdata, mid, properties=None):
         """Callback for message publish - v2.0+ compatible"""
-        logger.debug(f"Message {mid} published successfully")
+        logger.debug("Message %d published successfully", mid)
         
     def on_message(self, client, userdata, message):
         """Handle incoming MQTT command messages"""
@@ -98,8 +174,8 @@ class UWBPublisher:
         except Exception as e:
             logger.error(f"Error processing MQTT command: {e}")
         
-    def connect(self, initial_rate_hz: float = 0.1) -> bool:
-        """Connect to MQTT broker"""
+    async def connect(self, initial_rate_hz: float = 0.1) -> bool:
+        """Connect to MQTT broker, driving the client's socket from the running event loop"""
         try:
             # Initialize publish rate
             with self.rate_limit_lock:
@@ -108,70 +184,215 @@ class UWBPublisher:
             # Create client with explicit callback API version for v2.0+
             self.client = mqtt.Client(
                 callback_api_version=mqtt.CallbackAPIVersion.VERSION1,
-                client_id=self.client_id
+                client_id=self.client_id,
+                protocol=mqtt.MQTTv5
             )
             
+            # Let QoS 1/2 publishes overlap their acknowledgements instead of waiting on each one
+            self.client.max_inflight_messages_set(64)
+            self.client.max_queued_messages_set(1024)
+            
             self.client.on_connect = self.on_connect
             self.client.on_disconnect = self.on_disconnect
             self.client.on_publish = self.on_publish
             self.client.on_message = self.on_message
             
+            # No network thread: the event loop reads and writes the socket when it is ready
+            self._loop = asyncio.get_running_loop()
+            self.client.on_socket_open = self.on_socket_open
+            self.client.on_socket_close = self.on_socket_close
+            self.client.on_socket_register_write = self.on_socket_register_write
+            self.client.on_socket_unregister_write = self.on_socket_unregister_write
+            
             logger.info(f"Connecting to MQTT broker {self.broker}:{self.port}...")
             self.client.connect(self.broker, self.port, 60)
-            self.client.loop_start()
             
             # Wait for connection
             timeout = 10
             while not self.connected and timeout > 0:
-                time.sleep(0.1)
+                await asyncio.sleep(0.1)
                 timeout -= 0.1
                 
             if not self.connected:
                 logger.error("Connection timeout")
                 return False
                 
+            # Advertise the payload encoding as a retained message so consumers can auto-detect it.
+            # It is sent once and acknowledged before any data, and the broker keeps it across reconnects.
+            result = self.client.publish(self.format_topic, self.payload_format, qos=1, retain=True)
+            timeout = 10
+            while not result.is_published() and timeout > 0:
+                await asyncio.sleep(0.1)
+                timeout -= 0.1
+                
+            if not result.is_published():
+                logger.error("Format advertisement was not acknowledged")
+                return False
+                
             return True
             
         except Exception as e:
             logger.error(f"Connection error: {e}")
             return False
             
-    def disconnect(self):
+    async def disconnect(self):
         """Disconnect from MQTT broker"""
         if self.client:
-            self.client.loop_stop()
+            if self._misc_task is not None:
+                self._misc_task.cancel()
+                self._misc_task = None
             self.client.disconnect()
+            # The DISCONNECT packet is written by the event loop, so give it a moment to go out
+            timeout = 1
+            while self.client.socket() is not None and timeout > 0:
+                await asyncio.sleep(0.1)
+                timeout -= 0.1
+                
+    def on_socket_open(self, client, userdata, sock):
+        """Watch a newly opened broker socket for incoming packets"""
+        self._loop.add_reader(sock, client.loop_read)
+        # The event loop only holds tasks weakly, so keep a reference; a reconnect reuses the running task
+        if self._misc_task is None or self._misc_task.done():
+            self._misc_task = self._loop.create_task(self._misc_loop())
+        
+    def on_socket_close(self, client, userdata, sock):
+        """Stop watching a closed broker socket"""
+        self._loop.remove_reader(sock)
+        
+    def on_socket_register_write(self, client, userdata, sock):
+        """Flush outgoing packets once the socket can take them"""
+        self._loop.add_writer(sock, client.loop_write)
+        
+    def on_socket_unregister_write(self, client, userdata, sock):
+        """Stop waiting for the socket to become writable once paho's buffer is empty"""
+        self._loop.remove_writer(sock)
+        
+    async def _misc_loop(self):
+        """Run paho's keepalive and retry timers, reconnecting if the connection is lost"""
+        while self.running:
+            while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                await asyncio.sleep(1)
+                
+            await asyncio.sleep(self.RECONNECT_DELAY)
+            if not self.running:
+                break
+            try:
+                # The new socket is kept alive by the loop above
+                self.client.reconnect()
+            except Exception as e:
+                logger.warning(f"Reconnect failed: {e}")
             
     def get_current_sleep_time(self) -> float:
         """Get current sleep time between publishes in seconds (thread-safe)"""
         with self.rate_limit_lock:
             return 1.0 / self.current_publish_rate if self.current_publish_rate > 0 else 10.0
             
-    def publish_distances(self, distances: List[Tuple[str, str, float]]) -> bool:
+    def format_distances(self, distances: List[Tuple[str, str, float]]) -> list:
+        """Convert to required format: [["node1", "node2", distance], ...]"""
+        return [[node1, node2, distance] for node1, node2, distance in distances]
+        
+    def encode_distances_json(self, distances: List[Tuple[str, str, float]]) -> bytes:
+        """Encode distances as a JSON array, reusing the pre-rendered '["node1","node2",' prefix of each pair"""
+        prefixes = self._json_prefixes
+        parts = []
+        for node1, node2, distance in distances:
+            prefix = prefixes.get((node1, node2))
+            if prefix is None:
+                prefix = prefixes[(node1, node2)] = json.dumps([node1, node2], separators=(',', ':'))[:-1].encode() + b','
+            parts.append(b'%s%.2f]' % (prefix, distance))
+        return b'[' + b','.join(parts) + b']'
+            
+    async def publish_distances(self, distances: List[Tuple[str, str, float]]) -> bool:
         """Publish distance measurements to MQTT topic"""
+        if self.payload_format == "msgpack":
+            message = msgpack.packb(self.format_distances(distances), use_single_float=True)
+        else:
+            message = self.encode_distances_json(distances)
+        if not await self._publish(message):
+            return False
+            
+        logger.info("📤 Published %d simulated distance measurements", len(distances))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Payload: %s", message)
+        return True
+        
+    async def publish_batch(self, batch: List[List[Tuple[str, str, float]]]) -> bool:
+        """Publish several measurement sets as one {"ts": ..., "frames": [...]} message"""
+        message_data = {"ts": time.time(), "frames": [self.format_distances(distances) for distances in batch]}
+        if self.payload_format == "msgpack":
+            message = msgpack.packb(message_data, use_single_float=True)
+        else:
+            message = encode_json(message_data)
+        if not await self._publish(message):
+            return False
+            
+        logger.info("📤 Published batch of %d simulated measurement sets", len(batch))
+        return True
+        
+    async def _publish(self, message: bytes) -> bool:
+        """Publish one encoded message to the data topic"""
         if not self.connected:
             logger.error("Not connected to MQTT broker")
             return False
             
         try:
-            # Convert to required format: [["node1", "node2", distance], ...]
-            message_data = [[node1, node2, round(distance, 2)] for node1, node2, distance in distances]
-            message = json.dumps(message_data)
-            
-            result = self.client.publish(self.topic, message, qos=1)
-            
-            if result.rc == mqtt.MQTT_ERR_SUCCESS:
-                logger.info(f"📤 Published {len(distances)} simulated distance measurements")
-                logger.debug(f"Sample: {message_data[0] if message_data else 'No data'}")
-                return True
-            else:
-                logger.error(f"Failed to publish message, return code {result.rc}")
-                return False
+            for topic in self.data_topics:
+                result = self._publish_to(topic, message)
+                
+                if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                    logger.error(f"Failed to publish message, return code {result.rc}")
+                    return False
+                    
+            # Periodically let the broker catch up so unacknowledged messages cannot pile up in paho
+            self._publish_count += 1
+            if self.qos > 0 and self._publish_count % self.BACKPRESSURE_INTERVAL == 0:
+                # The PUBACK is read by this event loop, so yield to it instead of blocking in wait_for_publish
+                deadline = self._loop.time() + 1.0
+                while not result.is_published() and self._loop.time() < deadline:
+                    await asyncio.sleep(0.01)
+            return True
                 
         except Exception as e:
             logger.error(f"Publish error: {e}")
             return False
 
+    def _publish_to(self, topic: str, message: bytes) -> mqtt.MQTTMessageInfo:
+        """Publish to one topic, replacing the topic name with an MQTT v5 alias once one is set up"""
+        # QoS 1/2 messages can be resent after a reconnect, when the alias is no longer valid
+        if self.qos > 0:
+            return self.client.publish(topic, message, qos=self.qos, retain=False)
+            
+        properties = self._topic_aliases.get(topic)
+        if properties is not None:
+            return self.client.publish("", message, qos=0, retain=False, properties=properties)
+            
+        if len(self._topic_aliases) < self._topic_alias_max:
+            # The first publish carries both the topic and its alias to register it with the broker
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.TopicAlias = len(self._topic_aliases) + 1
+            result = self.client.publish(topic, message, qos=0, retain=False, properties=properties)
+            if result.rc == mqtt.MQTT_ERR_SUCCESS:
+                self._topic_aliases[topic] = properties
+            return result
+            
+        return self.client.publish(topic, message, qos=0, retain=False)
+
+def _pairwise_distances(positions, noise, out):
+    """Write noisy distances for each upper-triangle node pair into out"""
+    node_count = positions.shape[0]
+    k = 0
+    for i in range(node_count):
+        for j in range(i + 1, node_count):
+            dx = positions[i, 0] - positions[j, 0]
+            dy = positions[i, 1] - positions[j, 1]
+            out[k] = max(0.1, math.sqrt(dx * dx + dy * dy) + noise[k])
+            k += 1
+
+if njit is not None:
+    _pairwise_distances = njit(cache=True, fastmath=True)(_pairwise_distances)
+    # Compile (or load from cache) at import so the first simulated tick is not held up by the JIT
+    _pairwise_distances(np.zeros((2, 2)), np.zeros(1), np.empty(1))
+
 class SimulationGenerator:
     """
     Generate simulated UWB positioning data for testing
@@ -187,83 +408,171 @@ class SimulationGenerator:
     the UWB Position Visualiser without requiring real hardware.
     """
     
-    def __init__(self):
+    def __init__(self, seed: Optional[int] = None):
         # Define node positions in a coordinate system (metres)
-        self.nodes = {
-            "B5A4": (0.0, 0.0),      # Gateway at origin
-            "R001": (3.0, 2.0),      # Room 1
-            "R002": (1.5, 4.0),      # Room 2  
-            "R003": (5.0, 3.5),      # Room 3
-            "T001": (2.0, 2.5),      # Mobile tag 1
-        }
+        self.node_ids = ["B5A4", "R001", "R002", "R003", "T001"]
+        self.positions = np.array([
+            [0.0, 0.0],      # Gateway at origin
+            [3.0, 2.0],      # Room 1
+            [1.5, 4.0],      # Room 2
+            [5.0, 3.5],      # Room 3
+            [2.0, 2.5],      # Mobile tag 1
+        ])
         
         # Movement parameters for mobile tags
         self.mobile_tags = ["T001"]
-        self.time_offset = 0.0
+        self.tick = 0
+        
+        # T001 moves in a circular pattern; one lap is precomputed so each tick is a table lookup
+        center_x, center_y = 2.5, 2.5
+        radius = 1.5
+        self.orbit_steps = round(2 * math.pi / (0.1 * 0.3))  # Slow circular movement, ~0.03 rad per tick
+        angles = np.arange(self.orbit_steps) * (2 * math.pi / self.orbit_steps)
+        self._orbit = np.column_stack((center_x + radius * np.cos(angles),
+                                       center_y + radius * np.sin(angles)))
         
         # Add some realistic measurement noise
         self.noise_stddev = 0.05  # 5cm standard deviation
+        self._rng = np.random.default_rng(seed)
+        
+        # Node pairs never change, so their indices and ids are looked up once
+        node_count = len(self.node_ids)
+        self._pair_rows, self._pair_cols = np.triu_indices(node_count, 1)
+        self._pair_names = [(self.node_ids[i], self.node_ids[j])
+                            for i, j in zip(self._pair_rows.tolist(), self._pair_cols.tolist())]
+        self._node_index = {node_id: i for i, node_id in enumerate(self.node_ids)}
         
-    def calculate_distance(self, pos1: Tuple[float, float], pos2: Tuple[float, float]) -> float:
-        """Calculate distance between two positions"""
-        dx = pos1[0] - pos2[0]
-        dy = pos1[1] - pos2[1]
-        distance = math.sqrt(dx*dx + dy*dy)
+        # Work buffers reused on every tick instead of allocating new arrays
+        pair_count = len(self._pair_names)
+        self._pair_starts = np.empty((pair_count, 2))
+        self._pair_deltas = np.empty((pair_count, 2))
+        self._pair_distances = np.empty(pair_count)
+        self._noise = np.empty(pair_count)
         
+    def calculate_distances(self) -> np.ndarray:
+        """Calculate noisy distances for each node pair in upper-triangle order, rounded to cm
+        
+        The returned array is a shared buffer that is overwritten by the next call.
+        """
         # Add realistic measurement noise
-        noise = random.gauss(0, self.noise_stddev)
-        distance += noise
+        noise = self._rng.standard_normal(out=self._noise)
+        noise *= self.noise_stddev
+        
+        if njit is not None:
+            _pairwise_distances(self.positions, noise, self._pair_distances)
+        else:
+            # Only the N(N-1)/2 unique pairs are computed, not the full N x N matrix
+            np.take(self.positions, self._pair_rows, axis=0, out=self._pair_starts)
+            np.take(self.positions, self._pair_cols, axis=0, out=self._pair_deltas)
+            np.subtract(self._pair_starts, self._pair_deltas, out=self._pair_deltas)
+            np.hypot(self._pair_deltas[:, 0], self._pair_deltas[:, 1], out=self._pair_distances)
+            self._pair_distances += noise
+            
+            # Ensure positive distance
+            np.maximum(self._pair_distances, 0.1, out=self._pair_distances)
         
-        # Ensure positive distance
-        return max(0.1, distance)
+        return np.round(self._pair_distances, 2, out=self._pair_distances)
         
     def update_mobile_positions(self):
         """Update positions of mobile tags"""
-        self.time_offset += 0.1
+        self.tick = (self.tick + 1) % self.orbit_steps
         
         for tag in self.mobile_tags:
             if tag == "T001":
                 # Move T001 in a circular pattern
-                center_x, center_y = 2.5, 2.5
-                radius = 1.5
-                angle = self.time_offset * 0.3  # Slow circular movement
-                
-                new_x = center_x + radius * math.cos(angle)
-                new_y = center_y + radius * math.sin(angle)
-                
-                self.nodes[tag] = (new_x, new_y)
+                self.positions[self._node_index[tag]] = self._orbit[self.tick]
                 
     def generate_distances(self) -> List[Tuple[str, str, float]]:
         """Generate distance measurements between all node pairs"""
         self.update_mobile_positions()
         
-        distances = []
-        node_list = list(self.nodes.keys())
+        distances = self.calculate_distances()
         
-        # Generate distances between all pairs
-        for i in range(len(node_list)):
-            for j in range(i + 1, len(node_list)):
-                node1 = node_list[i]
-                node2 = node_list[j]
-                
-                pos1 = self.nodes[node1]
-                pos2 = self.nodes[node2]
-                
-                distance = self.calculate_distance(pos1, pos2)
-                distances.append((node1, node2, distance))
-                
-        return distances
+        return [(node1, node2, d) for (node1, node2), d in zip(self._pair_names, distances.tolist())]
 
-def signal_handler(signum, frame):
-    """Handle Ctrl+C gracefully"""
-    logger.info("Received interrupt signal, shutting down...")
-    global publisher
-    if publisher:
+async def publish_loop(publisher: UWBPublisher, data_source: SimulationGenerator,
+                       batch_size: int, batch_timeout: float):
+    """Generate and publish measurement sets until interrupted"""
+    loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    
+    def request_stop():
+        """Handle Ctrl+C gracefully"""
+        logger.info("Received interrupt signal, shutting down...")
         publisher.running = False
+        stop_event.set()
+        
+    try:
+        loop.add_signal_handler(signal.SIGINT, request_stop)
+    except NotImplementedError:
+        # Event loops on Windows cannot install signal handlers
+        signal.signal(signal.SIGINT, lambda signum, frame: loop.call_soon_threadsafe(request_stop))
+    
+    batch = []
+    batch_started = 0.0
+    # Ticks are scheduled against a monotonic deadline so time spent publishing does not add drift
+    deadline = loop.time()
+    
+    while publisher.running:
+        # Get distance measurements
+        distances = data_source.generate_distances()
+            
+        if distances:
+            if batch_size > 1:
+                # Hold measurement sets until the batch is full, stale batches are sent while waiting below
+                if not batch:
+                    batch_started = deadline
+                batch.append(distances)
+                if len(batch) >= batch_size:
+                    if not await publisher.publish_batch(batch):
+                        logger.warning("Failed to publish data")
+                    batch = []
+            # Publish to MQTT
+            elif not await publisher.publish_distances(distances):
+                logger.warning("Failed to publish data")
+        
+        # Use dynamic sleep time that can be updated via MQTT commands
+        deadline += publisher.get_current_sleep_time()
+        if deadline <= loop.time():
+            # Fell behind, so restart the schedule rather than bursting to catch up
+            deadline = loop.time()
+            
+        while publisher.running:
+            # Wake early to send a partial batch once it has been held for batch_timeout;
+            # a timeout landing on the next tick (within rounding) still goes out before it
+            batch_due = batch_started + batch_timeout if batch else math.inf
+            delay = min(deadline, batch_due) - loop.time()
+            if delay > 0:
+                # Wait on the stop event rather than sleeping so Ctrl+C takes effect immediately
+                try:
+                    await asyncio.wait_for(stop_event.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+            if batch_due > deadline + 1e-6:
+                break
+            if publisher.running:
+                if not await publisher.publish_batch(batch):
+                    logger.warning("Failed to publish data")
+                batch = []
+            
+    # Send any partial batch rather than dropping it on shutdown
+    if batch and not await publisher.publish_batch(batch):
+        logger.warning("Failed to publish data")
+
+async def run_simulation(publisher: UWBPublisher, data_source: SimulationGenerator, rate: float,
+                         batch_size: int, batch_timeout: float) -> int:
+    """Connect, publish until interrupted and disconnect, all on one event loop"""
+    try:
+        if not await publisher.connect(rate):
+            logger.error("Failed to connect to MQTT broker")
+            return 1
+        await publish_loop(publisher, data_source, batch_size, batch_timeout)
+        return 0
+    finally:
+        publisher.running = False
+        await publisher.disconnect()
 
 def main():
-    global publisher
-    
     parser = argparse.ArgumentParser(
         description='UWB Position Data MQTT Publisher - Simulation Mode',
         epilog='This tool simulates realistic UWB positioning data for testing the visualiser.'
@@ -276,6 +585,20 @@ def main():
                        help='MQTT topic for publishing (default: uwb/positions)')
     parser.add_argument('--rate', type=float, default=0.1,
                        help='Publishing rate in Hz (default: 0.1 = every 10 seconds)')
+    parser.add_argument('--format', choices=['json', 'msgpack'], default='json',
+                       help='Payload encoding; msgpack publishes to <topic>.msgpack (default: json)')
+    parser.add_argument('--qos', type=int, choices=[0, 1, 2], default=0,
+                       help='MQTT QoS level for distance data; the visualiser only uses the latest set (default: 0)')
+    parser.add_argument('--batch', '--batch-size', dest='batch', type=int, default=1,
+                       help='Number of measurement sets to send per MQTT message (default: 1)')
+    parser.add_argument('--batch-timeout-ms', type=float, default=5000,
+                       help='Maximum milliseconds to hold a partial batch before publishing (default: 5000)')
+    parser.add_argument('--topics-count', type=int, default=1,
+                       help='Publish each message to this many numbered topics for fan-out testing (default: 1)')
+    parser.add_argument('--topic-prefix', default=None,
+                       help='Prefix for fan-out topic names (default: <topic>/)')
+    parser.add_argument('--seed', type=int, default=None,
+                       help='Seed for simulated measurement noise, for reproducible runs (default: random)')
     parser.add_argument('--debug', action='store_true',
                        help='Enable debug logging (default: False)')
     
@@ -284,18 +607,16 @@ def main():
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
         
-    # Set up signal handler for graceful shutdown
-    signal.signal(signal.SIGINT, signal_handler)
-    
-    # Create MQTT publisher
-    publisher = UWBPublisher(args.broker, args.port, args.topic)
-    
-    if not publisher.connect(args.rate):
-        logger.error("Failed to connect to MQTT broker")
+    if args.format == 'msgpack' and msgpack is None:
+        logger.error("msgpack not installed. Run: pip install msgpack")
         return 1
         
+    # Create MQTT publisher
+    publisher = UWBPublisher(args.broker, args.port, args.topic, payload_format=args.format, qos=args.qos,
+                             topics_count=args.topics_count, topic_prefix=args.topic_prefix)
+    
     # Set up data source
-    data_source = SimulationGenerator()
+    data_source = SimulationGenerator(seed=args.seed)
     logger.info("🎭 SIMULATION MODE: Generating realistic UWB test data")
     logger.info("📍 Simulated network: Gateway B5A4 + 3 rooms + 1 mobile tag")
     logger.info("🔄 Mobile tag T001 moving in circular pattern with 5cm measurement noise")
@@ -310,29 +631,25 @@ def main():
     logger.info("📡 Rate can be changed remotely via MQTT commands")
     logger.info("⛔ Press Ctrl+C to stop simulation")
     
+    if sys.platform == "win32":
+        # The Proactor loop used by default on Windows cannot watch sockets with add_reader/add_writer
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        
+    exit_code = 0
+    simulation = run_simulation(publisher, data_source, args.rate, args.batch, args.batch_timeout_ms / 1000)
     try:
-        while publisher.running:
-            # Get distance measurements
-            distances = data_source.generate_distances()
-                
-            if distances:
-                # Publish to MQTT
-                if not publisher.publish_distances(distances):
-                    logger.warning("Failed to publish data")
-            
-            # Use dynamic sleep time that can be updated via MQTT commands
-            sleep_time = publisher.get_current_sleep_time()
-            time.sleep(sleep_time)
-            
+        if uvloop is not None:
+            exit_code = uvloop.run(simulation)
+        else:
+            exit_code = asyncio.run(simulation)
+        
     except Exception as e:
         logger.error(f"Unexpected error: {e}")
         
     finally:
-        # Cleanup
-        publisher.disconnect()
         logger.info("🛑 UWB simulation stopped")
         
-    return 0
+    return exit_code
 
 if __name__ == "__main__":
     sys.exit(main())
\ No newline at end of file
@@ -173,6 +173,11 @@ class MQTTManager {
             
             if (Array.isArray(distanceData)) {
                 this.visualizer.processDistanceData(distanceData);
+            } else if (distanceData && Array.isArray(distanceData.frames)) {
+                // Batched publishers wrap several measurement sets as {"ts": ..., "frames": [...]}
+                distanceData.frames.forEach((frame) => {
+                    this.visualizer.processDistanceData(frame);
+                });
             } else {
                 this.visualizer.logWarning('⚠️ Invalid message format - expected array');
             }
